@@ -1,13 +1,16 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import duckdb
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import io
+from itertools import islice
 
 # Load environment variables
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -20,6 +23,22 @@ BASE_URL = "https://intervals.icu/api/v1"
 # Database Configuration
 DB_PATH = os.path.join(PROJECT_ROOT, "data", "intervals.duckdb")
 
+# Activities are listed in date windows of this many days.
+ACTIVITIES_WINDOW_DAYS = 31
+
+# Download Configuration
+# Streams are written to DuckDB (single writer) in batches of BATCH_SIZE.
+BATCH_SIZE = 50
+MAX_WORKERS = 10
+PARSE_WORKERS = os.cpu_count() or 1
+
+# Shared session so stream downloads reuse pooled keep-alive connections
+# instead of opening (and TLS-handshaking) a new one per request.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+)
+
 
 def validate_config():
     if not API_KEY or not ATHLETE_ID:
@@ -58,6 +77,10 @@ def init_db(con):
 
     # Create streams table (initially minimal, will evolve)
     # We enforce activity_id and time at minimum.
+    # This stays a native DuckDB table rather than per-activity Parquet shards:
+    # storage is already columnar and compressed, process_data scans every
+    # activity anyway (so partition pruning would skip nothing), and
+    # per-activity deletes go through the activity_id index below.
     con.execute(
         """
         CREATE TABLE IF NOT EXISTS raw_streams (
@@ -73,9 +96,13 @@ def init_db(con):
     )
 
 
-def get_activities(start_date=None, end_date=None):
+def iter_activity_pages(
+    start_date=None, end_date=None, window_days=ACTIVITIES_WINDOW_DAYS
+):
     """
-    Fetch list of activities for the athlete.
+    Fetch activities for the athlete in consecutive date windows.
+    Yields one list of activities per window, so a long history is never
+    held in a single response.
     Defaults to last 3 years if no dates provided.
     """
     if not start_date:
@@ -84,17 +111,40 @@ def get_activities(start_date=None, end_date=None):
         end_date = datetime.now().strftime("%Y-%m-%d")
 
     url = f"{BASE_URL}/athlete/{ATHLETE_ID}/activities"
-    params = {"oldest": start_date, "newest": end_date}
     auth = ("API_KEY", API_KEY)
 
     print(f"Fetching activities from {start_date} to {end_date}...")
-    response = requests.get(url, auth=auth, params=params)
+    window_start = datetime.strptime(start_date, "%Y-%m-%d")
+    last_day = datetime.strptime(end_date, "%Y-%m-%d")
 
-    if response.status_code != 200:
-        print(f"Failed to fetch activities: {response.status_code} - {response.text}")
-        return []
+    while window_start <= last_day:
+        # oldest/newest are inclusive, so windows must not share a day.
+        window_end = min(window_start + timedelta(days=window_days - 1), last_day)
+        params = {
+            "oldest": window_start.strftime("%Y-%m-%d"),
+            "newest": window_end.strftime("%Y-%m-%d"),
+        }
+        response = requests.get(url, auth=auth, params=params)
 
-    return response.json()
+        if response.status_code != 200:
+            print(
+                f"Failed to fetch activities: {response.status_code} - {response.text}"
+            )
+            return
+
+        yield response.json()
+        window_start = window_end + timedelta(days=1)
+
+
+def get_activities(start_date=None, end_date=None):
+    """
+    Fetch list of activities for the athlete.
+    Defaults to last 3 years if no dates provided.
+    """
+    activities = []
+    for page in iter_activity_pages(start_date, end_date):
+        activities.extend(page)
+    return activities
 
 
 def save_activities_metadata(con, activities):
@@ -106,36 +156,59 @@ def save_activities_metadata(con, activities):
 
     print(f"Saving metadata for {len(activities)} activities...")
 
-    # Prepare data for insertion
-    # We map specific fields and dump the rest as JSON
-    data = []
-    for act in activities:
-        data.append(
-            {
-                "id": act.get("id"),
-                "start_date_local": act.get("start_date_local"),
-                "name": act.get("name"),
-                "type": act.get("type"),
-                "moving_time": act.get("moving_time"),
-                "elapsed_time": act.get("elapsed_time"),
-                "trainer": act.get("trainer"),
-                "commute": act.get("commute"),
-                "distance": act.get("distance"),
-                "total_elevation_gain": act.get("total_elevation_gain"),
-                "sport": act.get("sport"),
-                "raw_json": json.dumps(act),
-            }
+    # Serialize each activity once; json_extract_string pulls all mapped
+    # fields out of that JSON in one call per row.
+    activities_json = pa.table({"raw_json": [json.dumps(act) for act in activities]})
+
+    # Upsert (INSERT OR REPLACE)
+    # INSERT OR REPLACE works because id is the primary key.
+    con.execute(
+        """
+        INSERT OR REPLACE INTO activities
+        SELECT
+            f[1] AS id,
+            CAST(f[2] AS TIMESTAMP) AS start_date_local,
+            f[3] AS name,
+            f[4] AS type,
+            CAST(CAST(f[5] AS DOUBLE) AS INTEGER) AS moving_time,
+            CAST(CAST(f[6] AS DOUBLE) AS INTEGER) AS elapsed_time,
+            CAST(f[7] AS BOOLEAN) AS trainer,
+            CAST(f[8] AS BOOLEAN) AS commute,
+            CAST(f[9] AS REAL) AS distance,
+            CAST(f[10] AS REAL) AS total_elevation_gain,
+            f[11] AS sport,
+            CAST(raw_json AS JSON) AS raw_json
+        FROM (
+            SELECT
+                raw_json,
+                json_extract_string(
+                    raw_json,
+                    [
+                        '$.id', '$.start_date_local', '$.name', '$.type',
+                        '$.moving_time', '$.elapsed_time', '$.trainer',
+                        '$.commute', '$.distance', '$.total_elevation_gain',
+                        '$.sport'
+                    ]
+                ) AS f
+            FROM activities_json
         )
+    """
+    )
 
-    df = pd.DataFrame(data)
 
-    # Upsert (INSERT OR REPLACE)
-    # DuckDB doesn't have native UPSERT in the same way for bulk insert via DF easily without temp table,
-    # but INSERT OR REPLACE works if PK exists.
-    # Let's register DF and insert.
-    con.register("temp_activities", df)
-    con.execute("INSERT OR REPLACE INTO activities SELECT * FROM temp_activities")
-    con.unregister("temp_activities")
+def find_missing_streams(con, activity_ids):
+    """
+    Return the activity ids that have no streams stored in raw_streams yet.
+    """
+    if not activity_ids:
+        return []
+
+    # The anti-join runs inside DuckDB, so stored ids never cross into Python.
+    new_acts = pa.table({"id": activity_ids})
+    rows = con.execute(
+        "SELECT id FROM new_acts EXCEPT SELECT activity_id FROM raw_streams"
+    ).fetchall()
+    return [row[0] for row in rows]
 
 
 def fetch_stream_content(activity_id):
@@ -145,7 +218,7 @@ def fetch_stream_content(activity_id):
     url = f"{BASE_URL}/activity/{activity_id}/streams.csv"
     auth = ("API_KEY", API_KEY)
     try:
-        response = requests.get(url, auth=auth, timeout=10)
+        response = _SESSION.get(url, auth=auth, timeout=10)
         if response.status_code == 200:
             return activity_id, response.content
         else:
@@ -156,70 +229,242 @@ def fetch_stream_content(activity_id):
         return activity_id, None
 
 
-def process_stream_batch(con, streams_data):
+def download_streams(activity_ids, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+    """
+    Download stream CSVs in parallel, yielding batches of (activity_id, content).
+
+    At most 2 * batch_size downloads are in flight, and more are submitted as
+    they finish, so the pool keeps fetching while the caller writes the
+    previous batch to DuckDB without holding the whole history in memory.
+    """
+    pending_ids = iter(activity_ids)
+    window = 2 * batch_size
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        in_flight = {
+            executor.submit(fetch_stream_content, aid)
+            for aid in islice(pending_ids, window)
+        }
+
+        batch = []
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                aid, content = future.result()
+                if content:
+                    batch.append((aid, content))
+
+            # Refill the window; finished futures are no longer referenced.
+            in_flight |= {
+                executor.submit(fetch_stream_content, aid)
+                for aid in islice(pending_ids, len(done))
+            }
+
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+
+        if batch:
+            yield batch
+    finally:
+        # If the caller stops early, queued downloads are dropped instead of
+        # waited on.
+        executor.shutdown(cancel_futures=True)
+
+
+def quote_identifier(name):
+    """
+    Quote a column name taken from a stream CSV header for use in SQL.
+    """
+    # Identifiers cannot be bound as parameters, so embedded quotes are escaped.
+    escaped = name.replace('"', '""')
+    return f'"{escaped}"'
+
+
+def arrow_type_to_sql(dtype):
+    """
+    Map an Arrow type inferred from a stream CSV to a DuckDB column type.
+    """
+    if pa.types.is_integer(dtype):
+        return "BIGINT"
+    if pa.types.is_floating(dtype) or pa.types.is_null(dtype):
+        # Empty columns parse as null; keep them numeric.
+        return "DOUBLE"
+    if pa.types.is_boolean(dtype):
+        return "BOOLEAN"
+    return "VARCHAR"  # Fallback
+
+
+def promote_arrow_types(current, new):
+    """
+    Widen two Arrow types seen for the same stream column into one that
+    holds both. current is None the first time a column is seen.
+    """
+    if current is None or pa.types.is_null(current):
+        return new
+    if pa.types.is_null(new) or current == new:
+        return current
+    if pa.types.is_integer(current) and pa.types.is_integer(new):
+        return pa.int64()
+    numeric = (pa.types.is_integer, pa.types.is_floating)
+    if any(f(current) for f in numeric) and any(f(new) for f in numeric):
+        return pa.float64()
+    return pa.string()
+
+
+def cast_stream_table(table, column_types):
+    """
+    Cast a parsed stream table's columns to the batch-wide Arrow types.
+    """
+    schema = pa.schema(
+        [(field.name, column_types[field.name]) for field in table.schema]
+    )
+    return table.cast(schema)
+
+
+def parse_stream_csv(content):
+    """
+    Parse raw stream CSV bytes into an Arrow table.
+    """
+    # Stream CSVs are plain numeric samples, so opt out of quoted-newline
+    # handling and let the reader chunk on every line break.
+    parse_options = pacsv.ParseOptions(newlines_in_values=False)
+    # Batches are parsed one CSV per worker thread, so each read stays
+    # single-threaded instead of oversubscribing the cores.
+    read_options = pacsv.ReadOptions(use_threads=False)
+    return pacsv.read_csv(
+        io.BytesIO(content), read_options=read_options, parse_options=parse_options
+    )
+
+
+def parse_activity_stream(activity_id, content):
+    """
+    Parse one activity's stream CSV and tag every row with its activity_id.
+    Returns None for empty, header-only or unparseable streams.
+    """
+    try:
+        # Parse the raw bytes straight into Arrow, without decoding them
+        # to a Python string first.
+        stream_table = parse_stream_csv(content)
+    except Exception as e:
+        print(f"Failed to process stream for {activity_id}: {e}")
+        return None
+
+    # Check if empty or just header
+    if stream_table.num_rows == 0:
+        return None
+
+    return stream_table.append_column(
+        "activity_id",
+        pa.array([activity_id] * stream_table.num_rows, type=pa.string()),
+    )
+
+
+def write_streams(con, tables, skip_existing=False):
+    """
+    Write parsed stream tables to raw_streams in a single transaction.
+    Raises on failure, after rolling back.
+    """
+    # Schema changes happen before this, outside the transaction. The DELETE
+    # and INSERT commit together: one WAL sync per call, and a failed INSERT
+    # leaves the previously stored streams untouched.
+    con.execute("BEGIN TRANSACTION")
+    try:
+        # Activities may carry different stream columns; missing ones become
+        # nulls.
+        batch_streams = pa.concat_tables(tables, promote_options="permissive")
+
+        if not skip_existing:
+            # Delete existing streams for these activities to enable re-runs/updates
+            con.execute(
+                "DELETE FROM raw_streams WHERE activity_id IN "
+                "(SELECT DISTINCT activity_id FROM batch_streams)"
+            )
+        con.execute("INSERT INTO raw_streams BY NAME SELECT * FROM batch_streams")
+        con.execute("COMMIT")
+
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def process_stream_batch(con, streams_data, skip_existing=False):
     """
     Process a batch of downloaded stream contents (bytes) and insert into DuckDB.
-    Handles schema evolution.
+    Handles schema evolution. The whole batch is written with a single DELETE
+    and a single INSERT, falling back to one activity at a time if that fails.
+
+    Pass skip_existing=True when the activities are known to have no streams
+    stored yet (as in main()), which skips the DELETE entirely.
+
+    Returns the ids of activities whose streams could not be written.
     """
-    for activity_id, content in streams_data:
-        if not content:
-            continue
+    # Keep only the last download per activity, as sequential re-inserts would.
+    streams = {aid: content for aid, content in dict(streams_data).items() if content}
 
-        # 1. Parse CSV to Relation
-        # We wrap bytes in a BytesIO-like object or string
-        try:
-            csv_str = content.decode("utf-8")
-            # Check if empty or just header
-            if len(csv_str.strip().split("\n")) < 2:
+    # 1. Parse CSV to Arrow
+    # Parsing is CPU-bound and pyarrow releases the GIL, so CSVs are parsed on
+    # worker threads. All DuckDB writes below stay on this thread (single writer).
+    with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+        parsed = executor.map(parse_activity_stream, streams.keys(), streams.values())
+        tables = [table for table in parsed if table is not None]
+
+    if not tables:
+        return []
+
+    # 2. Schema Evolution
+    # Column types are collected across the whole batch first and promoted,
+    # so each new column is added once with a type that fits every activity.
+    batch_types = {}
+    for stream_table in tables:
+        for field in stream_table.schema:
+            batch_types[field.name] = promote_arrow_types(
+                batch_types.get(field.name), field.type
+            )
+
+    try:
+        existing_cols_info = con.execute("PRAGMA table_info(raw_streams)").fetchall()
+        existing_cols = {row[1] for row in existing_cols_info}  # row[1] is name
+
+        for name, dtype in batch_types.items():
+            if name in existing_cols:
                 continue
+            sql_type = arrow_type_to_sql(dtype)
+            print(
+                f"Schema Evolution: Adding column '{name}' ({sql_type}) to raw_streams"
+            )
+            con.execute(
+                f"ALTER TABLE raw_streams ADD COLUMN {quote_identifier(name)} "
+                f"{sql_type}"
+            )
+
+    except Exception as e:
+        print(f"Failed to evolve raw_streams schema: {e}")
+        return [table.column("activity_id")[0].as_py() for table in tables]
+
+    # Arrow can only merge int with float on its own, so every activity is
+    # cast to the promoted types up front (e.g. int to string).
+    tables = [cast_stream_table(table, batch_types) for table in tables]
 
-            # DuckDB can read from CSV string?
-            # Easiest way via python client is pandas or read_csv with file-like.
-            # Let's use Pandas for robustness with small CSVs, then DuckDB.
-            df = pd.read_csv(io.StringIO(csv_str))
-
-            # Add activity_id
-            df["activity_id"] = activity_id
-
-            # 2. Schema Evolution
-            # Get existing columns in raw_streams
-            existing_cols_info = con.execute(
-                "PRAGMA table_info(raw_streams)"
-            ).fetchall()
-            existing_cols = {row[1] for row in existing_cols_info}  # row[1] is name
-
-            new_cols = [col for col in df.columns if col not in existing_cols]
-
-            for col in new_cols:
-                # Infer type from DF
-                dtype = df[col].dtype
-                sql_type = "VARCHAR"  # Fallback
-                if pd.api.types.is_integer_dtype(dtype):
-                    sql_type = "BIGINT"
-                elif pd.api.types.is_float_dtype(dtype):
-                    sql_type = "DOUBLE"
-                elif pd.api.types.is_bool_dtype(dtype):
-                    sql_type = "BOOLEAN"
-
-                print(
-                    f"Schema Evolution: Adding column '{col}' ({sql_type}) to raw_streams"
-                )
-                con.execute(f'ALTER TABLE raw_streams ADD COLUMN "{col}" {sql_type}')
-
-            # 3. Insert
-            # We assume activity_id is clean.
-            # Delete existing streams for this activity to enable re-runs/updates
-            con.execute(f"DELETE FROM raw_streams WHERE activity_id = '{activity_id}'")
-
-            # Append
-            con.register("temp_stream", df)
-            # We need to insert matching columns.
-            # 'INSERT INTO raw_streams BY NAME SELECT * FROM temp_stream' is supported in recent DuckDB!
-            con.execute("INSERT INTO raw_streams BY NAME SELECT * FROM temp_stream")
-            con.unregister("temp_stream")
+    # 3. Insert
+    # The whole batch is tried in one transaction first. If it fails (e.g. a
+    # value that does not fit an existing column), each activity is retried
+    # on its own so one bad stream does not drop the rest of the batch.
+    try:
+        write_streams(con, tables, skip_existing)
+        return []
+    except Exception as e:
+        print(f"Failed to write batch of {len(tables)} streams, retrying each: {e}")
 
+    failed = []
+    for stream_table in tables:
+        activity_id = stream_table.column("activity_id")[0].as_py()
+        try:
+            write_streams(con, [stream_table], skip_existing)
         except Exception as e:
-            print(f"Failed to process stream for {activity_id}: {e}")
+            print(f"Failed to write streams for {activity_id}: {e}")
+            failed.append(activity_id)
+    return failed
 
 
 def main():
@@ -231,23 +476,17 @@ def main():
     init_db(con)
 
     # 1. Get List of Activities
-    activities = get_activities()
-    save_activities_metadata(con, activities)
-
-    # 2. Identify Missing Streams?
-    # Or just sync all?
-    # User said "incremental update" in original plan, but "bulk download" in verification.
-    # Let's check which IDs are already in raw_streams.
-    existing_ids = {
-        row[0]
-        for row in con.execute(
-            "SELECT DISTINCT activity_id FROM raw_streams"
-        ).fetchall()
-    }
-
-    to_download = [act["id"] for act in activities if act["id"] not in existing_ids]
+    # Metadata is saved window by window; only the ids are kept for the full range.
+    activity_ids = []
+    for activities in iter_activity_pages():
+        save_activities_metadata(con, activities)
+        activity_ids.extend(act["id"] for act in activities)
+
+    # 2. Identify Missing Streams
+    # Only activities without any rows in raw_streams are downloaded.
+    to_download = find_missing_streams(con, activity_ids)
     print(
-        f"Found {len(activities)} activities. {len(existing_ids)} exist in DB. {len(to_download)} to download."
+        f"Found {len(activity_ids)} activities. {len(activity_ids) - len(to_download)} exist in DB. {len(to_download)} to download."
     )
 
     if not to_download:
@@ -256,30 +495,19 @@ def main():
         return
 
     # 3. Parallel Download
-    # Batch size for DB insertion to avoid creating too many small transactions or locking issues?
-    # DuckDB single-writer. We should fetch in parallel, then write sequentially in batches.
-
-    BATCH_SIZE = 50
-    MAX_WORKERS = 10
-
-    # Chunk the download list
-    for i in range(0, len(to_download), BATCH_SIZE):
-        batch_ids = to_download[i : i + BATCH_SIZE]
-        print(f"Processing batch {i} to {i+len(batch_ids)}...")
-
-        results = []
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_id = {
-                executor.submit(fetch_stream_content, aid): aid for aid in batch_ids
-            }
-            for future in as_completed(future_to_id):
-                aid, content = future.result()
-                if content:
-                    results.append((aid, content))
+    # DuckDB single-writer. We fetch in parallel, then write sequentially in batches.
+    # Downloads keep running in the background while each batch is written.
+    written = 0
+    for results in download_streams(to_download):
+        print(f"Processing batch {written} to {written + len(results)}...")
 
         # Write batch to DB
-        process_stream_batch(con, results)
-        print(f"Committed batch of {len(results)} streams.")
+        # to_download only holds activities without streams, so nothing to delete.
+        failed = process_stream_batch(con, results, skip_existing=True)
+        written += len(results)
+        print(f"Committed batch of {len(results) - len(failed)} streams.")
+        if failed:
+            print(f"Failed to store streams for: {', '.join(failed)}")
 
     con.close()
     print("Done.")
@@ -1,12 +1,14 @@
 import os
 import json
 import duckdb
-import pandas as pd
+import numpy as np
+import pyarrow as pa
 import random
 from datetime import datetime, timedelta
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_PATH = os.path.join(PROJECT_ROOT, "data", "intervals_test.duckdb")
+POINTS_PER_ACTIVITY = 100
 
 
 def init_db(con):
@@ -76,28 +78,37 @@ def generate_synthetic_data(num_activities=10):
             }
         )
 
-        # Generate Streams
-        # 100 data points
-        stream_data = []
-        hr = 100
-        for t in range(100):
-            power = 100 + (t % 50) * 2
-            target_hr = 100 + (power - 100) * 0.5 + (t * 0.05)
-            hr += (target_hr - hr) * 0.1
-            stream_data.append(
-                {
-                    "activity_id": activity_id,
-                    "time": t,
-                    "watts": int(power),
-                    "heartrate": int(hr),
-                }
-            )
-
-        # Bulk Insert Streams
-        con.execute("INSERT INTO raw_streams SELECT * FROM pd.DataFrame(stream_data)")
-
-    # Validating activities insert
-    con.execute("INSERT INTO activities SELECT * FROM pd.DataFrame(activities_data)")
+    # Generate Streams
+    # 100 data points. Every synthetic activity follows the same profile, so
+    # it is computed once, tiled across activities and inserted in one go.
+    t = np.arange(POINTS_PER_ACTIVITY)
+    power = 100 + (t % 50) * 2
+    target_hr = 100 + (power - 100) * 0.5 + (t * 0.05)
+    # HR drifts towards its target, starting from 100. The recurrence stays a
+    # loop (the profile is computed once, not per activity); unrolling it
+    # into a cumsum divides by 0.9 ** k, which overflows on long rides.
+    hr = np.empty(POINTS_PER_ACTIVITY)
+    current_hr = 100.0
+    for k in range(POINTS_PER_ACTIVITY):
+        current_hr += (target_hr[k] - current_hr) * 0.1
+        hr[k] = current_hr
+
+    activity_ids = [act["id"] for act in activities_data]
+    streams = pa.table(
+        {
+            "activity_id": np.repeat(activity_ids, POINTS_PER_ACTIVITY),
+            "time": np.tile(t, num_activities).astype(np.int32),
+            "watts": np.tile(power, num_activities).astype(np.int32),
+            "heartrate": np.tile(hr, num_activities).astype(np.int32),
+        }
+    )
+
+    # Bulk Insert Streams
+    con.execute("INSERT INTO raw_streams SELECT * FROM streams")
+
+    # Insert activities from an Arrow table, scanned by DuckDB in place
+    activities_table = pa.Table.from_pylist(activities_data)
+    con.execute("INSERT INTO activities SELECT * FROM activities_table")
 
     count_act = con.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
     count_stream = con.execute("SELECT COUNT(*) FROM raw_streams").fetchone()[0]
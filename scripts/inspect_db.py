@@ -26,6 +26,23 @@ def inspect():
     except Exception as e:
         print(f"Could not inspect raw_streams: {e}")
 
+    # On-disk compression per column. activity_id repeats once per sample, so
+    # DuckDB should store it dictionary/FSST-compressed rather than as plain strings.
+    print("\nStorage: raw_streams compression")
+    try:
+        rows = con.execute(
+            """
+            SELECT column_name, compression, COUNT(*) AS segments
+            FROM pragma_storage_info('raw_streams')
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            """
+        ).fetchall()
+        for row in rows:
+            print(row)
+    except Exception as e:
+        print(f"Could not inspect raw_streams storage: {e}")
+
     con.close()
 
 
@@ -7,15 +7,27 @@ DB_PATH = os.path.join(PROJECT_ROOT, "data", "intervals.duckdb")
 OUTPUT_FILE = "fitness_metrics.parquet"
 
 
-def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR):
-    os.makedirs(processed_dir, exist_ok=True)
-    output_path = os.path.join(processed_dir, OUTPUT_FILE)
+def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR, con=None):
+    # An already open connection can be passed in and is left open, which
+    # avoids a close/reopen cycle; otherwise db_path is opened and closed here.
+    if con is not None:
+        process_connection(con, processed_dir)
+        return
 
     if not os.path.exists(db_path):
         print(f"Error: {db_path} not found. Run fetch_data.py first.")
         return
 
     con = duckdb.connect(db_path)
+    try:
+        process_connection(con, processed_dir)
+    finally:
+        con.close()
+
+
+def process_connection(con, processed_dir=PROCESSED_DIR):
+    os.makedirs(processed_dir, exist_ok=True)
+    output_path = os.path.join(processed_dir, OUTPUT_FILE)
 
     print("Processing streams from DuckDB...")
 
@@ -27,36 +39,24 @@ def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR):
     cols = [col[1] for col in con.execute("PRAGMA table_info(raw_streams)").fetchall()]
     if "watts" not in cols or "heartrate" not in cols:
         print("Error: 'watts' or 'heartrate' columns missing from raw_streams.")
-        con.close()
         return
 
     # User wanted "Bin HR for each watt".
-    # We cast watts to integer to 'bin' it.
+    # We cast watts to integer to 'bin' it, and exclude zeros.
+    # daily_fitness_metrics is a view: it stays queryable for downstream
+    # readers, but the aggregate is never materialized in the database. The
+    # COPY below streams it straight into Parquet. No ORDER BY: readers (the
+    # dashboard queries) sort their own results, so sorting here is wasted work.
+
+    # Older runs stored daily_fitness_metrics as a table.
+    legacy_table = con.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE table_name = 'daily_fitness_metrics'"
+    ).fetchone()
+    if legacy_table:
+        con.execute("DROP TABLE daily_fitness_metrics")
 
     query = """
-        CREATE OR REPLACE TABLE daily_fitness_metrics AS
-        SELECT 
-            CAST(a.start_date_local AS DATE) as date,
-            CAST(s.watts AS INTEGER) as watts,
-            AVG(s.heartrate) as heartrate
-        FROM raw_streams s
-        JOIN activities a ON s.activity_id = a.id
-        WHERE s.watts IS NOT NULL 
-          AND s.heartrate IS NOT NULL
-          AND s.moving = 'true' -- Optional refinement: only consider moving time? 
-                                -- The stream usually has 'moving' boolean if fetched, but user requested 'watts'/'hr'.
-                                -- Let's stick to base request.
-        GROUP BY 1, 2
-        ORDER BY 1, 2
-    """
-
-    # Check if 'moving' column exists dynamically?
-    # Let's stick to the simpler query first.
-    # Check if user needs filtering. "bin my HR for each watt of power I produced".
-    # Usually you want to exclude zeros.
-
-    query = """
-        CREATE OR REPLACE TABLE daily_fitness_metrics AS
+        CREATE OR REPLACE VIEW daily_fitness_metrics AS
         SELECT 
             CAST(a.start_date_local AS DATE) as date,
             CAST(s.watts AS INTEGER) as watts,
@@ -67,18 +67,20 @@ def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR):
         WHERE s.watts > 0 
           AND s.heartrate > 0
         GROUP BY 1, 2
-        ORDER BY 1, 2
     """
 
     con.execute(query)
 
-    # 5. Export
-    con.execute(query)
-
     # 5. Export Fitness Metrics
-    con.execute(f"COPY daily_fitness_metrics TO '{output_path}' (FORMAT PARQUET)")
-
-    count = con.execute("SELECT COUNT(*) FROM daily_fitness_metrics").fetchone()[0]
+    con.execute(
+        f"COPY (SELECT * FROM daily_fitness_metrics) TO '{output_path}' "
+        "(FORMAT PARQUET, COMPRESSION ZSTD)"
+    )
+
+    # The row count is in the Parquet footer; no need to re-run the aggregate.
+    count = con.execute(
+        "SELECT num_rows FROM parquet_file_metadata(?)", [output_path]
+    ).fetchone()[0]
     print(f"Processed fitness metrics saved to {output_path}. Rows: {count}")
 
     # 6. Spatial Data Processing (Routes)
@@ -88,39 +90,25 @@ def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR):
         con.load_extension("spatial")
 
         # We need to construct LineStrings from points.
-        # ST_MakeLine(ST_Point(lat, lon)) grouped by activity and ordered by time.
-        # Note: DuckDB's spatial extension might require points to be constructed first.
-        # Also, we need to handle the list aggregation.
-
-        # Strategy:
-        # 1. Select relevant points (lat/lng not null) ordered by time per activity.
-        # 2. Use list_aggr to create a list of points or geometries?
-        #    Actually, `ST_MakeLine` can take a list of geometries (points).
+        # ST_MakeLine takes a list of point geometries, so each activity's
+        # points are collected in time order with ordered list aggregates.
+        # Geometry, streams, averages and duration all come out of a single
+        # grouped scan, with no separate global sort.
 
         spatial_query = """
             CREATE OR REPLACE TABLE workout_routes AS
-            WITH ordered_points AS (
-                SELECT 
+            WITH routes AS (
+                SELECT
                     s.activity_id,
-                    s.time,
-                    ST_Point(s.lng, s.lat) as geom,
-                    s.watts,
-                    s.heartrate
+                    ST_MakeLine(list(ST_Point(s.lng, s.lat) ORDER BY s.time)) as geometry,
+                    list(s.watts ORDER BY s.time) as watts_stream,
+                    list(s.heartrate ORDER BY s.time) as hr_stream,
+                    AVG(s.watts) as avg_watts,
+                    AVG(s.heartrate) as avg_hr,
+                    MAX(s.time) - MIN(s.time) as duration_seconds
                 FROM raw_streams s
                 WHERE s.lat IS NOT NULL AND s.lng IS NOT NULL
-                ORDER BY s.activity_id, s.time
-            ),
-            routes AS (
-                SELECT
-                    activity_id,
-                    ST_MakeLine(list(geom)) as geometry,
-                    list(watts) as watts_stream,
-                    list(heartrate) as hr_stream,
-                    AVG(watts) as avg_watts,
-                    AVG(heartrate) as avg_hr,
-                    MAX(time) - MIN(time) as duration_seconds
-                FROM ordered_points
-                GROUP BY activity_id
+                GROUP BY s.activity_id
             )
             SELECT
                 r.*,
@@ -161,8 +149,6 @@ def process_data(db_path=DB_PATH, processed_dir=PROCESSED_DIR):
         # Let's verify if spatial extension issues are common.
         # For now, print error.
 
-    con.close()
-
 
 def main():
     try:
@@ -0,0 +1,188 @@
+import shutil
+
+import pytest
+import duckdb
+import numpy as np
+import pandas as pd
+
+from process_data import process_data
+
+
+def create_mock_data(con):
+    # Tables come from the base_db fixture; rows are built up front and
+    # loaded with one append per table.
+    activities = pd.DataFrame(
+        {
+            "id": ["act1", "act2", "act3"],
+            "start_date_local": pd.to_datetime(
+                ["2023-01-01 10:00:00", "2023-01-02 10:00:00", "2023-01-03 10:00:00"]
+            ),
+            "name": ["Steady Ride", "Intervals", "Zero Ride"],
+            "type": ["Ride", "Ride", "Ride"],
+            "moving_time": [3600, 3600, 3600],
+        }
+    )
+
+    # Streams are built column-wise from NumPy arrays
+    n = 10
+    # 1. Activity 1: Steady 100W, 120HR (Valid), 10 seconds of data
+    act1_watts = np.full(n, 100.0)
+    act1_hr = np.full(n, 120.0)
+
+    # 2. Activity 2: Varying Power (100W, 200W) (Valid)
+    act2_watts = np.concatenate([np.full(5, 100.0), np.full(5, 200.0)])
+    act2_hr = np.concatenate([np.full(5, 110.0), np.full(5, 150.0)])
+
+    # 3. Activity 3: Zeros/Nulls (Should be filtered)
+    # 0 Watts -> Filter, 0 HR -> Filter, Null Watts -> Filter, Valid
+    act3_watts = np.array([0.0, 100.0, np.nan, 100.0])
+    act3_hr = np.array([100.0, 0.0, 100.0, 100.0])
+
+    total = 2 * n + len(act3_watts)
+    streams = pd.DataFrame(
+        {
+            "activity_id": np.repeat(["act1", "act2", "act3"], [n, n, len(act3_watts)]),
+            "time": np.concatenate(
+                [np.arange(n), np.arange(n), np.arange(len(act3_watts))]
+            ).astype(np.int32),
+            "watts": np.concatenate([act1_watts, act2_watts, act3_watts]),
+            "heartrate": np.concatenate([act1_hr, act2_hr, act3_hr]),
+            "lat": np.zeros(total),
+            "lng": np.zeros(total),
+            "moving": np.full(total, "true"),
+        }
+    )
+
+    con.append("activities", activities)
+    con.append("raw_streams", streams)
+
+
+def setup_data(con):
+    # Tables come from the base_db fixture; only rows are added here.
+    # Insert sample data for one activity
+    # A simple diagonal line: (0,0) -> (1,1)
+    activities = pd.DataFrame(
+        {
+            "id": ["act1"],
+            "name": ["Test Ride"],
+            "start_date_local": pd.to_datetime(["2023-01-01 10:00:00"]),
+        }
+    )
+    streams = pd.DataFrame(
+        {
+            "activity_id": ["act1", "act1"],
+            "time": [0, 10],  # Point 1, Point 2
+            "lat": [0.0, 1.0],
+            "lng": [0.0, 1.0],
+            "watts": [100.0, 150.0],
+            "heartrate": [120.0, 130.0],
+            "moving": ["true", "true"],
+        }
+    )
+
+    # by_name matches columns by name, so the frames can skip unused columns.
+    con.append("activities", activities, by_name=True)
+    con.append("raw_streams", streams, by_name=True)
+
+
+@pytest.fixture(scope="session")
+def spatial_extension():
+    # Installing may download the extension, so do it once per session.
+    # Connections opened afterwards only need the cheap load_extension.
+    con = duckdb.connect()
+    con.install_extension("spatial")
+    con.close()
+
+
+@pytest.fixture(scope="session")
+def base_db(tmp_path_factory):
+    # Empty activities/raw_streams schema shared by the test modules.
+    # Built once per session; tests copy the file instead of replaying DDL.
+    path = str(tmp_path_factory.mktemp("base") / "base.duckdb")
+    con = duckdb.connect(path)
+    con.execute(
+        """
+        CREATE TABLE activities (
+            id VARCHAR PRIMARY KEY,
+            start_date_local TIMESTAMP,
+            name VARCHAR,
+            type VARCHAR,
+            moving_time INTEGER
+        )
+    """
+    )
+    con.execute(
+        """
+        CREATE TABLE raw_streams (
+            activity_id VARCHAR,
+            time INTEGER,
+            watts DOUBLE,
+            heartrate DOUBLE,
+            lat DOUBLE,
+            lng DOUBLE,
+            moving VARCHAR
+        )
+    """
+    )
+    con.close()
+    return path
+
+
+@pytest.fixture(scope="session")
+def analysis_paths(tmp_path_factory):
+    # (db_path, processed_dir) for test_process_data.py
+    base = tmp_path_factory.mktemp("analysis")
+    processed_dir = base / "processed"
+    processed_dir.mkdir()
+    return str(base / "test_analysis.duckdb"), str(processed_dir)
+
+
+@pytest.fixture(scope="session")
+def setup_test_environment(analysis_paths, base_db, spatial_extension):
+    db_path, _ = analysis_paths
+
+    # Initialize DB from the prebuilt schema
+    shutil.copyfile(base_db, db_path)
+    con = duckdb.connect(db_path)
+    # Load Spatial for completeness as process_data tries to use it
+    con.load_extension("spatial")
+
+    yield con
+
+    con.close()
+
+
+@pytest.fixture(scope="session")
+def processed_metrics(setup_test_environment, analysis_paths):
+    # Mock data loaded and process_data run once, on the open connection.
+    # Every test that reads its results requests this, so none depends on
+    # another test having run first (e.g. on another xdist worker).
+    _, processed_dir = analysis_paths
+    con = setup_test_environment
+    create_mock_data(con)
+    process_data(processed_dir=processed_dir, con=con)
+    return con
+
+
+@pytest.fixture(scope="session")
+def spatial_paths(tmp_path_factory, base_db, spatial_extension):
+    # (db_path, processed_dir) for test_spatial.py, starting from the prebuilt schema
+    base = tmp_path_factory.mktemp("spatial")
+    processed_dir = base / "processed"
+    processed_dir.mkdir()
+    db_path = str(base / "test_spatial.duckdb")
+    shutil.copyfile(base_db, db_path)
+    return db_path, str(processed_dir)
+
+
+@pytest.fixture(scope="session")
+def processed_spatial(spatial_paths):
+    # Mock route loaded and process_data run once through the db_path entry
+    # point that main() uses (it opens and closes its own connection).
+    db_path, processed_dir = spatial_paths
+    con = duckdb.connect(db_path)
+    setup_data(con)
+    con.close()
+
+    process_data(db_path=db_path, processed_dir=processed_dir)
+    return db_path, processed_dir
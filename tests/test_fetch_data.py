@@ -1,38 +1,30 @@
 import unittest
 from unittest.mock import patch, MagicMock
 import os
-import sys
 import pandas as pd
 import duckdb
 import json
-
-# Add parent directory to path
-sys.path.append(
-    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
-)
+from datetime import datetime
 
 import fetch_data
 
 
+# Mock env vars; as a class decorator this wraps each test method directly
+@patch.dict(
+    os.environ,
+    {"INTERVALS_API_KEY": "test_key", "INTERVALS_ATHLETE_ID": "test_athlete"},
+)
 class TestFetchDataDuckDB(unittest.TestCase):
 
     def setUp(self):
         # Use in-memory DuckDB for DB logic tests
         self.con = duckdb.connect(":memory:")
 
-        # Setup mock env vars
-        self.env_patcher = patch.dict(
-            os.environ,
-            {"INTERVALS_API_KEY": "test_key", "INTERVALS_ATHLETE_ID": "test_athlete"},
-        )
-        self.env_patcher.start()
         fetch_data.API_KEY = "test_key"
         fetch_data.ATHLETE_ID = "test_athlete"
 
     def tearDown(self):
         self.con.close()
-        self.env_patcher.stop()
-        patch.stopall()
 
     def test_init_db(self):
         """Test that tables are created with correct schema"""
@@ -95,6 +87,34 @@ class TestFetchDataDuckDB(unittest.TestCase):
         count = self.con.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
         self.assertEqual(count, 1)
 
+    def test_save_activities_metadata_fields(self):
+        """Test mapped fields are typed and the full record is kept as JSON"""
+        fetch_data.init_db(self.con)
+
+        activity = {
+            "id": "act1",
+            "start_date_local": "2023-01-01T10:00:00",
+            "name": "Commute",
+            "moving_time": 1800,
+            "trainer": False,
+            "commute": True,
+            "distance": 12000.5,
+            "icu_training_load": 42,
+        }
+        fetch_data.save_activities_metadata(self.con, [activity])
+
+        res = self.con.execute(
+            """
+            SELECT start_date_local, moving_time, trainer, commute, distance, sport,
+                   raw_json->>'$.icu_training_load'
+            FROM activities WHERE id='act1'
+            """
+        ).fetchone()
+        self.assertEqual(
+            res,
+            (datetime(2023, 1, 1, 10, 0), 1800, False, True, 12000.5, None, "42"),
+        )
+
     def test_process_stream_batch_schema_evolution(self):
         """Test adding new columns dynamically and inserting data"""
         fetch_data.init_db(self.con)
@@ -142,6 +162,143 @@ class TestFetchDataDuckDB(unittest.TestCase):
         ).fetchone()[0]
         self.assertEqual(count, 2)
 
+    def test_process_stream_batch_multiple_activities(self):
+        """Test a batch of streams with differing columns is written together"""
+        fetch_data.init_db(self.con)
+
+        streams_data = [
+            ("act1", b"time,watts\n1,100\n2,110"),
+            ("act2", b"time,watts,heartrate\n1,200,140\n2,210,145\n3,220,150"),
+        ]
+
+        fetch_data.process_stream_batch(self.con, streams_data)
+
+        counts = self.con.execute(
+            "SELECT activity_id, COUNT(*) FROM raw_streams GROUP BY 1 ORDER BY 1"
+        ).fetchall()
+        self.assertEqual(counts, [("act1", 2), ("act2", 3)])
+
+        # act1 has no heartrate column, so it is filled with NULLs
+        res = self.con.execute(
+            "SELECT heartrate FROM raw_streams WHERE activity_id='act1'"
+        ).fetchall()
+        self.assertEqual(res, [(None,), (None,)])
+
+    def test_process_stream_batch_promotes_new_column_types(self):
+        """Test a new column seen as int and float in one batch becomes DOUBLE"""
+        fetch_data.init_db(self.con)
+
+        streams_data = [
+            ("act1", b"time,cadence\n1,80"),
+            ("act2", b"time,cadence\n1,80.5"),
+        ]
+        fetch_data.process_stream_batch(self.con, streams_data)
+
+        col_type = self.con.execute(
+            "SELECT type FROM pragma_table_info('raw_streams') WHERE name = 'cadence'"
+        ).fetchone()[0]
+        self.assertEqual(col_type, "DOUBLE")
+
+        res = self.con.execute(
+            "SELECT activity_id, cadence FROM raw_streams ORDER BY activity_id"
+        ).fetchall()
+        self.assertEqual(res, [("act1", 80.0), ("act2", 80.5)])
+
+    def test_process_stream_batch_promotes_int_and_string(self):
+        """Test a new column seen as int and string in one batch becomes VARCHAR"""
+        fetch_data.init_db(self.con)
+
+        streams_data = [
+            ("act1", b"time,device\n1,42"),
+            ("act2", b"time,device\n1,garmin"),
+        ]
+        fetch_data.process_stream_batch(self.con, streams_data)
+
+        col_type = self.con.execute(
+            "SELECT type FROM pragma_table_info('raw_streams') WHERE name = 'device'"
+        ).fetchone()[0]
+        self.assertEqual(col_type, "VARCHAR")
+
+        res = self.con.execute(
+            "SELECT activity_id, device FROM raw_streams ORDER BY activity_id"
+        ).fetchall()
+        self.assertEqual(res, [("act1", "42"), ("act2", "garmin")])
+
+    def test_process_stream_batch_skip_existing(self):
+        """Test that skip_existing appends without deleting prior rows"""
+        fetch_data.init_db(self.con)
+
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n1,100")])
+        # Re-sending act1 would replace its rows without skip_existing
+        fetch_data.process_stream_batch(
+            self.con, [("act1", b"time,watts\n2,200")], skip_existing=True
+        )
+
+        res = self.con.execute(
+            "SELECT time, watts FROM raw_streams WHERE activity_id='act1' ORDER BY time"
+        ).fetchall()
+        self.assertEqual(res, [(1, 100), (2, 200)])
+
+    def test_process_stream_batch_quoted_column(self):
+        """Test CSV headers containing quotes are added as columns safely"""
+        fetch_data.init_db(self.con)
+
+        fetch_data.process_stream_batch(self.con, [("act1", b'time,"a""b"\n1,5')])
+
+        cols = [
+            c[1] for c in self.con.execute("PRAGMA table_info(raw_streams)").fetchall()
+        ]
+        self.assertIn('a"b', cols)
+
+    def test_process_stream_batch_header_only(self):
+        """Test that a CSV with only a header inserts nothing"""
+        fetch_data.init_db(self.con)
+
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n")])
+
+        count = self.con.execute("SELECT COUNT(*) FROM raw_streams").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_process_stream_batch_rollback(self):
+        """Test a failed insert keeps the previously stored streams"""
+        fetch_data.init_db(self.con)
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n1,100")])
+
+        # watts is BIGINT now, so this insert fails after the DELETE ran
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n1,abc")])
+
+        res = self.con.execute(
+            "SELECT time, watts FROM raw_streams WHERE activity_id='act1'"
+        ).fetchall()
+        self.assertEqual(res, [(1, 100)])
+
+    def test_process_stream_batch_isolates_bad_activity(self):
+        """Test one bad stream in a batch does not drop the good ones"""
+        fetch_data.init_db(self.con)
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n1,100")])
+
+        # watts is BIGINT, so act3 cannot be inserted
+        failed = fetch_data.process_stream_batch(
+            self.con,
+            [("act2", b"time,watts\n1,200"), ("act3", b"time,watts\n1,abc")],
+        )
+
+        self.assertEqual(failed, ["act3"])
+        res = self.con.execute(
+            "SELECT activity_id, watts FROM raw_streams ORDER BY activity_id"
+        ).fetchall()
+        self.assertEqual(res, [("act1", 100), ("act2", 200)])
+
+    def test_find_missing_streams(self):
+        """Test that only activities without stored streams are returned"""
+        fetch_data.init_db(self.con)
+        fetch_data.process_stream_batch(self.con, [("act1", b"time,watts\n1,100")])
+
+        missing = fetch_data.find_missing_streams(self.con, ["act1", "act2", "act3"])
+
+        self.assertEqual(sorted(missing), ["act2", "act3"])
+        self.assertEqual(fetch_data.find_missing_streams(self.con, []), [])
+
     def test_process_stream_batch_type_casting(self):
         """Test that types are inferred correctly (FLOAT/DOUBLE for decimals)"""
         fetch_data.init_db(self.con)
@@ -156,6 +313,64 @@ class TestFetchDataDuckDB(unittest.TestCase):
         row = type_info[type_info["name"] == "velocity_smooth"].iloc[0]
         self.assertIn(row["type"], ["DOUBLE", "FLOAT"])
 
+    def test_parse_stream_csv_types(self):
+        """Test Arrow types inferred from a stream CSV map to DuckDB types"""
+        table = fetch_data.parse_stream_csv(
+            b"time,velocity_smooth,moving,label\n1,10.5,true,a\n2,11.2,false,b"
+        )
+        sql_types = {
+            field.name: fetch_data.arrow_type_to_sql(field.type)
+            for field in table.schema
+        }
+        self.assertEqual(
+            sql_types,
+            {
+                "time": "BIGINT",
+                "velocity_smooth": "DOUBLE",
+                "moving": "BOOLEAN",
+                "label": "VARCHAR",
+            },
+        )
+
+    @patch("fetch_data._SESSION.get")
+    def test_fetch_stream_content(self, mock_get):
+        """Test stream downloads go through the shared session"""
+        mock_get.return_value = MagicMock(status_code=200, content=b"time\n1")
+        self.assertEqual(fetch_data.fetch_stream_content("act1"), ("act1", b"time\n1"))
+
+        mock_get.return_value = MagicMock(status_code=404)
+        self.assertEqual(fetch_data.fetch_stream_content("act2"), ("act2", None))
+
+        url = mock_get.call_args_list[0].args[0]
+        self.assertTrue(url.endswith("/activity/act1/streams.csv"))
+
+    @patch("fetch_data.fetch_stream_content")
+    def test_download_streams_batches(self, mock_fetch):
+        """Test downloads are grouped into batches and failures dropped"""
+        mock_fetch.side_effect = lambda aid: (aid, None if aid == "bad" else b"csv")
+
+        batches = list(
+            fetch_data.download_streams(["a", "b", "bad", "c"], batch_size=2)
+        )
+
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        ids = sorted(aid for batch in batches for aid, _ in batch)
+        self.assertEqual(ids, ["a", "b", "c"])
+
+    @patch("fetch_data.fetch_stream_content")
+    def test_download_streams_bounded(self, mock_fetch):
+        """Test downloads are submitted in a bounded window and stop on close"""
+        mock_fetch.side_effect = lambda aid: (aid, b"csv")
+
+        batches = fetch_data.download_streams(
+            [f"act{i}" for i in range(100)], batch_size=2, max_workers=1
+        )
+        self.assertEqual(len(next(batches)), 2)
+        batches.close()
+
+        # Only the window (plus refills) was ever submitted, not all 100
+        self.assertLess(mock_fetch.call_count, 20)
+
     @patch("fetch_data.requests.get")
     def test_get_activities(self, mock_get):
         """Test API interaction"""
@@ -164,9 +379,34 @@ class TestFetchDataDuckDB(unittest.TestCase):
         mock_response.json.return_value = [{"id": "act1"}]
         mock_get.return_value = mock_response
 
-        acts = fetch_data.get_activities()
+        # A range inside one window is a single request
+        acts = fetch_data.get_activities("2023-01-01", "2023-01-15")
         self.assertEqual(len(acts), 1)
 
+    @patch("fetch_data.requests.get")
+    def test_get_activities_windows(self, mock_get):
+        """Test long ranges are fetched in non-overlapping date windows"""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.side_effect = [[{"id": "act1"}], [], [{"id": "act2"}]]
+        mock_get.return_value = mock_response
+
+        acts = fetch_data.get_activities("2023-01-01", "2023-03-15")
+
+        self.assertEqual([a["id"] for a in acts], ["act1", "act2"])
+        windows = [
+            (c.kwargs["params"]["oldest"], c.kwargs["params"]["newest"])
+            for c in mock_get.call_args_list
+        ]
+        self.assertEqual(
+            windows,
+            [
+                ("2023-01-01", "2023-01-31"),
+                ("2023-02-01", "2023-03-03"),
+                ("2023-03-04", "2023-03-15"),
+            ],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()